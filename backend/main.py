@@ -1,16 +1,18 @@
 import asyncio
-import json
 import logging
 import os
 import uuid
-from datetime import datetime, timedelta
-from typing import Dict, List, Optional, Set
+from datetime import datetime, timedelta, timezone
+from typing import Dict, List, Literal, Optional, Set, Tuple
 
+import httpx
+import msgspec
+import orjson
 import redis.asyncio as redis
 from dotenv import load_dotenv
 from fastapi import FastAPI, WebSocket, WebSocketDisconnect
 from fastapi.middleware.cors import CORSMiddleware
-from openai import AsyncOpenAI
+from openai import AsyncOpenAI, DefaultAsyncHttpxClient
 from pydantic import BaseModel, Field
 
 # --- Basic Setup ---
@@ -22,10 +24,30 @@ load_dotenv()
 REDIS_URL = os.getenv("REDIS_URL")  # Para Railway/Render
 REDIS_HOST = os.getenv("REDIS_HOST", "localhost") # Para Docker Compose local
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
+# Non-streamed, so the read timeout must cover the whole generation (~30-50 s for a
+# full batch); the card prefetcher already hides this latency from players
+OPENAI_TIMEOUT = httpx.Timeout(90.0, connect=5.0)
+# Idle time a pooled connection is kept; longer than a round so the next prefetch reuses it
+OPENAI_KEEPALIVE_SECONDS = 120.0
+OPENAI_MAX_TOKENS = 6000  # Room for CARD_COUNT cards; bounds worst-case latency
 ROUND_DURATION_SECONDS = 60
 CARD_COUNT = 20
-LEADERBOARD_KEY = "leaderboard"
+LEADERBOARD_KEY_PREFIX = "leaderboard"  # One sorted set per round: leaderboard:{round_id}
+LEADERBOARD_RETENTION_SECONDS = 60 * 60  # How long a finished round's scores are kept
+LEADERBOARD_TTL_SECONDS = ROUND_DURATION_SECONDS + LEADERBOARD_RETENTION_SECONDS
+ROUND_ID_KEY = "round:id"
 COOLDOWN_SECONDS = 0.3
+BROADCAST_SEND_TIMEOUT = 1.0
+# Score tables indexed by card difficulty (1-3); out-of-range values are clamped
+BASE_SCORE = (0, 30, 60, 100)
+PENALTY = (0, -20, -30, -40)
+INV_ROUND_DURATION = 1.0 / ROUND_DURATION_SECONDS
+CARD_PREFETCH_DEPTH = 2  # Rounds of cards generated ahead of time
+CARD_POOL_KEY = "cards:pool"  # Redis set of raw OpenAI responses, reused on cold start
+CARD_POOL_SIZE = 50
+CARD_PREFETCH_RETRY_SECONDS = 5
+LEADERBOARD_BROADCAST_INTERVAL = 0.1  # Coalesce score updates to at most 10 broadcasts/s
+LEADERBOARD_CACHE_TTL = 0.1
 
 # --- Pydantic Models for Data Structure ---
 class OfferCard(BaseModel):
@@ -41,19 +63,40 @@ class OfferCard(BaseModel):
     label: str  # "legitimo" or "pirata"
     difficulty: int
 
+# Incoming player actions are decoded with msgspec: they dominate the message rate
+class ClickMessage(msgspec.Struct):
+    action: Literal["approve", "denounce"]
+    card_id: str
+    round_id: Optional[int] = None
+
+click_decoder = msgspec.json.Decoder(ClickMessage)
+
 class GameState:
     def __init__(self):
+        self.round_id: int = 0
+        self.leaderboard_key: Optional[str] = None
         self.cards: List[OfferCard] = []
-        self.round_end_time: Optional[datetime] = None
+        self.card_index: Dict[str, OfferCard] = {}
+        # Deadline on the event loop's monotonic clock; cheap to compare per click
+        self.round_end_time: Optional[float] = None
+        # Human-readable deadline for clients, formatted once per round
+        self.expires_at: Optional[str] = None
+        # (loop time, encoded leaderboard_update message); cleared on every score change
+        self.leaderboard_cache: Optional[Tuple[float, bytes]] = None
+        # Bumped on every score change so a fetch that raced a write isn't cached
+        self.leaderboard_version: int = 0
+        # Pre-encoded payloads, built once per round since cards don't change
+        self.new_round_bytes: bytes = b""
+        self.game_state_bytes: bytes = b""
         self.lock = asyncio.Lock()
 
     def is_round_active(self) -> bool:
-        return self.round_end_time is not None and datetime.utcnow() < self.round_end_time
+        return self.round_end_time is not None and asyncio.get_running_loop().time() < self.round_end_time
 
     def get_time_remaining(self) -> int:
         if not self.is_round_active():
             return 0
-        return int((self.round_end_time - datetime.utcnow()).total_seconds())
+        return int(self.round_end_time - asyncio.get_running_loop().time())
 
 # --- Application Initialization ---
 app = FastAPI()
@@ -72,43 +115,80 @@ if REDIS_URL:
 else:
     logger.info(f"Connecting to Redis using REDIS_HOST: {REDIS_HOST}")
     redis_client = redis.Redis(host=REDIS_HOST, port=6379, decode_responses=True)
-openai_client = AsyncOpenAI(api_key=OPENAI_API_KEY)
+# Prefetches run about once per round, well past httpx's default 5 s keep-alive, so the
+# idle expiry is raised to let each call reuse the previous call's connection
+openai_client = AsyncOpenAI(
+    api_key=OPENAI_API_KEY,
+    timeout=OPENAI_TIMEOUT,
+    http_client=DefaultAsyncHttpxClient(
+        limits=httpx.Limits(
+            max_connections=1000,
+            max_keepalive_connections=100,
+            keepalive_expiry=OPENAI_KEEPALIVE_SECONDS,
+        ),
+    ),
+)
 game_state = GameState()
+leaderboard_dirty = asyncio.Event()
+card_queue: "asyncio.Queue[List[OfferCard]]" = asyncio.Queue(maxsize=CARD_PREFETCH_DEPTH)
 
 class ConnectionManager:
     def __init__(self):
         self.active_connections: Dict[str, WebSocket] = {}
-        self.last_click_time: Dict[str, datetime] = {}
+        self.last_click_time: Dict[str, float] = {}
+        # Strong references to background close tasks so they aren't garbage-collected mid-close
+        self._close_tasks: Set[asyncio.Task] = set()
 
     async def connect(self, websocket: WebSocket, client_id: str):
         await websocket.accept()
         self.active_connections[client_id] = websocket
         logger.info(f"Client {client_id} connected.")
 
-    def disconnect(self, client_id: str):
-        if client_id in self.active_connections:
-            del self.active_connections[client_id]
+    def disconnect(self, client_id: str, websocket: WebSocket):
+        # The client may already have reconnected on a new socket; leave that one alone
+        if self.active_connections.get(client_id) is not websocket:
+            return
+        del self.active_connections[client_id]
         if client_id in self.last_click_time:
             del self.last_click_time[client_id]
         logger.info(f"Client {client_id} disconnected.")
 
     def is_on_cooldown(self, client_id: str) -> bool:
-        now = datetime.utcnow()
+        now = asyncio.get_running_loop().time()
         last_click = self.last_click_time.get(client_id)
-        if last_click and (now - last_click).total_seconds() < COOLDOWN_SECONDS:
+        if last_click is not None and now - last_click < COOLDOWN_SECONDS:
             return True
         self.last_click_time[client_id] = now
         return False
 
-    async def broadcast(self, message: dict):
+    async def broadcast_bytes(self, data: bytes):
         if not self.active_connections:
             return
-        # Create a list of tasks to send messages concurrently
+        # Snapshot, since clients can connect or disconnect while sends are pending
+        connections = list(self.active_connections.items())
+        # Callers encode once; the same bytes go to every connection.
+        # Each send is bounded so one stalled client can't hold up the others.
         tasks = [
-            ws.send_json(message) for ws in self.active_connections.values()
+            asyncio.wait_for(ws.send_bytes(data), timeout=BROADCAST_SEND_TIMEOUT)
+            for _, ws in connections
         ]
         # Gather will run all tasks in parallel
-        await asyncio.gather(*tasks, return_exceptions=True)
+        results = await asyncio.gather(*tasks, return_exceptions=True)
+
+        # Drop dead or stalled sockets so later broadcasts don't keep paying for them
+        for (client_id, ws), result in zip(connections, results):
+            if isinstance(result, Exception) and self.active_connections.get(client_id) is ws:
+                logger.warning(f"Dropping client {client_id} after failed send: {result!r}")
+                self.disconnect(client_id, ws)
+                task = asyncio.create_task(self._close_quietly(ws))
+                self._close_tasks.add(task)
+                task.add_done_callback(self._close_tasks.discard)
+
+    async def _close_quietly(self, websocket: WebSocket):
+        try:
+            await asyncio.wait_for(websocket.close(), timeout=BROADCAST_SEND_TIMEOUT)
+        except Exception:
+            pass
 
 
 manager = ConnectionManager()
@@ -165,14 +245,19 @@ async def generate_cards_from_openai(num_cards: int) -> List[OfferCard]:
             ],
             response_format={"type": "json_object"},
             temperature=1.1,
+            max_tokens=OPENAI_MAX_TOKENS,
+            stream=False,
         )
         content = response.choices[0].message.content
-        card_data = json.loads(content)
-        cards = [OfferCard(**card) for card in card_data["cards"]]
+        cards = parse_cards(content)
         logger.info(f"Successfully generated {len(cards)} cards.")
+        await cache_cards(content)
         return cards
     except Exception as e:
         logger.error(f"Error generating cards from OpenAI: {e}")
+        cached_cards = await load_cached_cards()
+        if cached_cards:
+            return cached_cards
         # Fallback to a single dummy card in case of API failure
         return [OfferCard(
             id=str(uuid.uuid4()), product="camiseta", brand="Fallback Brand",
@@ -181,49 +266,159 @@ async def generate_cards_from_openai(num_cards: int) -> List[OfferCard]:
             signals=["API Error"], label="pirata", difficulty=1
         )]
 
+def parse_cards(content: str) -> List[OfferCard]:
+    card_data = orjson.loads(content)
+    return [OfferCard(**card) for card in card_data["cards"]]
+
+async def cache_cards(content: str):
+    try:
+        # Add and count in a single round-trip
+        async with redis_client.pipeline(transaction=False) as pipe:
+            pipe.sadd(CARD_POOL_KEY, content)
+            pipe.scard(CARD_POOL_KEY)
+            _, pool_size = await pipe.execute()
+        # Keep the pool bounded by dropping random old batches
+        excess = pool_size - CARD_POOL_SIZE
+        if excess > 0:
+            await redis_client.spop(CARD_POOL_KEY, excess)
+    except Exception as e:
+        logger.error(f"Error caching cards in Redis: {e}")
+
+async def load_cached_cards() -> Optional[List[OfferCard]]:
+    try:
+        content = await redis_client.srandmember(CARD_POOL_KEY)
+        if content:
+            cards = parse_cards(content)
+            logger.info(f"Loaded {len(cards)} cached cards from Redis.")
+            return cards
+    except Exception as e:
+        logger.error(f"Error loading cached cards from Redis: {e}")
+    return None
+
+async def card_prefetcher():
+    # Generate upcoming rounds while the current one is being played
+    # The game loop waits on this queue, so an error must never end the task
+    while True:
+        try:
+            cards = await generate_cards_from_openai(CARD_COUNT)
+            await card_queue.put(cards)
+        except Exception as e:
+            logger.error(f"Error prefetching cards: {e}")
+            await asyncio.sleep(CARD_PREFETCH_RETRY_SECONDS)
+
+async def next_round_cards() -> List[OfferCard]:
+    # On cold start, reuse a cached batch instead of waiting on OpenAI
+    if card_queue.empty():
+        cards = await load_cached_cards()
+        if cards:
+            return cards
+    return await card_queue.get()
+
 # --- Leaderboard Logic ---
 async def get_leaderboard(top_n: int = 10) -> List[Dict]:
-    scores = await redis_client.zrevrange(LEADERBOARD_KEY, 0, top_n - 1, withscores=True)
-    return [{"nickname": member.split(":")[1], "score": int(score)} for member, score in scores]
-
-async def update_score(client_id: str, nickname: str, score_change: int):
-    member = f"{client_id}:{nickname}"
+    if game_state.leaderboard_key is None:
+        return []
+    scores = await redis_client.zrevrange(game_state.leaderboard_key, 0, top_n - 1, withscores=True)
+    return [{"nickname": member, "score": int(score)} for member, score in scores]
+
+async def get_leaderboard_bytes() -> bytes:
+    now = asyncio.get_running_loop().time()
+    cached = game_state.leaderboard_cache
+    if cached and now - cached[0] < LEADERBOARD_CACHE_TTL:
+        return cached[1]
+    version = game_state.leaderboard_version
+    leaderboard = await get_leaderboard()
+    data = orjson.dumps({"type": "leaderboard_update", "leaderboard": leaderboard})
+    if game_state.leaderboard_version == version:
+        game_state.leaderboard_cache = (now, data)
+    return data
+
+async def claim_nickname(leaderboard_key: str, client_id: str, nickname: str) -> str:
+    # Leaderboard members are bare nicknames, so make sure each one maps to a single
+    # client within the round. Ownership lives and expires with the round's board.
+    owners_key = f"{leaderboard_key}:owners"
+    async with redis_client.pipeline(transaction=False) as pipe:
+        pipe.hsetnx(owners_key, nickname, client_id)
+        pipe.hget(owners_key, nickname)
+        pipe.expire(owners_key, LEADERBOARD_TTL_SECONDS)
+        _, owner, _ = await pipe.execute()
+    if owner == client_id:
+        return nickname
+    return f"{nickname} #{client_id[-4:]}"
+
+async def update_score(leaderboard_key: str, member: str, score_change: int):
     # Use ZINCRBY to atomically update the score. It returns the new score.
-    new_score = await redis_client.zincrby(LEADERBOARD_KEY, score_change, member)
+    # The round's key only exists once scored, so its TTL is (re)set in the same round-trip;
+    # no key is ever left without one, even across restarts.
+    async with redis_client.pipeline(transaction=False) as pipe:
+        pipe.zincrby(leaderboard_key, score_change, member)
+        pipe.expire(leaderboard_key, LEADERBOARD_TTL_SECONDS)
+        new_score, _ = await pipe.execute()
+    game_state.leaderboard_version += 1
+    game_state.leaderboard_cache = None
     return new_score
 
 # --- Game Logic ---
 def calculate_score(guess: str, card: OfferCard) -> int:
     correct_label = card.label
     is_correct = guess == correct_label
+    # Tolerate a stray difficulty from OpenAI rather than rejecting the whole batch
+    difficulty = min(max(card.difficulty, 1), 3)
 
     if is_correct:
         # Reward based on difficulty
-        base_score = {1: 30, 2: 60, 3: 100}.get(card.difficulty, 30)
+        base_score = BASE_SCORE[difficulty]
         time_left = game_state.get_time_remaining()
         # Bonus for speed, maxing out the base_score
-        time_bonus = int(base_score * (time_left / ROUND_DURATION_SECONDS))
+        time_bonus = int(base_score * time_left * INV_ROUND_DURATION)
         return base_score + time_bonus
     else:
         # Penalty based on difficulty
-        return {-1: -20, -2: -30, -3: -40}.get(card.difficulty, -20)
+        return PENALTY[difficulty]
+
+def encode_cards(cards: List[OfferCard]) -> bytes:
+    # Dump the validated models to plain dicts, which orjson encodes natively
+    return orjson.dumps([card.model_dump(mode="json") for card in cards])
 
 async def start_new_round():
     async with game_state.lock:
         logger.info("Starting new round...")
         
-        # Reset leaderboard for the new round
-        await redis_client.delete(LEADERBOARD_KEY)
-
-        game_state.cards = await generate_cards_from_openai(CARD_COUNT)
-        game_state.round_end_time = datetime.utcnow() + timedelta(seconds=ROUND_DURATION_SECONDS)
-        
-        # Announce new round to everyone
-        await manager.broadcast({
+        cards = await next_round_cards()
+        # ~10 KB once per round: encoding inline is cheaper than an executor hand-off,
+        # and model_dump/orjson hold the GIL anyway
+        cards_bytes = encode_cards(cards)
+
+        # Switch to a fresh leaderboard key instead of deleting the old one, so
+        # in-flight score updates can never land in the new round's board
+        game_state.round_id = await redis_client.incr(ROUND_ID_KEY)
+        game_state.leaderboard_key = f"{LEADERBOARD_KEY_PREFIX}:{game_state.round_id}"
+        game_state.leaderboard_version += 1
+        game_state.leaderboard_cache = None
+
+        game_state.cards = cards
+        game_state.card_index = {card.id: card for card in game_state.cards}
+        game_state.round_end_time = asyncio.get_running_loop().time() + ROUND_DURATION_SECONDS
+        game_state.expires_at = (datetime.now(timezone.utc) + timedelta(seconds=ROUND_DURATION_SECONDS)).isoformat()
+
+        # Serialize the round once; reused for the broadcast and every new connection.
+        # The card list was encoded a single time and is embedded verbatim in both messages.
+        cards_json = orjson.Fragment(cards_bytes)
+        game_state.new_round_bytes = orjson.dumps({
             "type": "new_round",
-            "cards": [card.model_dump() for card in game_state.cards],
-            "expires_at": game_state.round_end_time.isoformat()
+            "round_id": game_state.round_id,
+            "cards": cards_json,
+            "expires_at": game_state.expires_at
+        })
+        game_state.game_state_bytes = orjson.dumps({
+            "type": "game_state",
+            "round_id": game_state.round_id,
+            "cards": cards_json,
+            "expires_at": game_state.expires_at
         })
+
+        # Announce new round to everyone
+        await manager.broadcast_bytes(game_state.new_round_bytes)
         logger.info("New round broadcasted to all clients.")
 
 async def game_loop():
@@ -233,75 +428,117 @@ async def game_loop():
         
         logger.info("Round ended. Broadcasting final leaderboard.")
         final_leaderboard = await get_leaderboard()
-        await manager.broadcast({"type": "round_end", "leaderboard": final_leaderboard})
+        await manager.broadcast_bytes(orjson.dumps({
+            "type": "round_end",
+            "round_id": game_state.round_id,
+            "leaderboard": final_leaderboard
+        }))
         
         # Short pause before starting the next round
         await asyncio.sleep(5)
 
+async def leaderboard_publisher():
+    while True:
+        await leaderboard_dirty.wait()
+        # Let a burst of clicks accumulate into a single frame per client
+        await asyncio.sleep(LEADERBOARD_BROADCAST_INTERVAL)
+        leaderboard_dirty.clear()
+        try:
+            await manager.broadcast_bytes(await get_leaderboard_bytes())
+        except Exception as e:
+            logger.error(f"Error broadcasting leaderboard: {e}")
+
+
+# --- Background Tasks ---
+# The event loop only holds weak references to tasks, so keep our own
+background_tasks: Set[asyncio.Task] = set()
+
+def _on_background_task_done(task: asyncio.Task):
+    background_tasks.discard(task)
+    if not task.cancelled() and task.exception() is not None:
+        logger.error(f"Background task {task.get_name()} crashed", exc_info=task.exception())
+
+def start_background_task(coro, name: str) -> asyncio.Task:
+    task = asyncio.create_task(coro, name=name)
+    background_tasks.add(task)
+    task.add_done_callback(_on_background_task_done)
+    return task
+
 
 # --- WebSocket Endpoint ---
 @app.websocket("/ws/{client_id}/{nickname}")
 async def websocket_endpoint(websocket: WebSocket, client_id: str, nickname: str):
     await manager.connect(websocket, client_id)
-    
-    # Send current game state to the new client
-    async with game_state.lock:
-        if game_state.is_round_active():
-            await websocket.send_json({
-                "type": "game_state",
-                "cards": [card.model_dump() for card in game_state.cards],
-                "expires_at": game_state.round_end_time.isoformat()
-            })
-    
-    # Send current leaderboard
-    leaderboard = await get_leaderboard()
-    await websocket.send_json({"type": "leaderboard_update", "leaderboard": leaderboard})
+    # Leaderboard name for this client, claimed on its first score in each round
+    leaderboard_name: Optional[str] = None
+    named_round_id: Optional[int] = None
 
     try:
+        # Send current game state to the new client
+        async with game_state.lock:
+            if game_state.is_round_active():
+                await websocket.send_bytes(game_state.game_state_bytes)
+
+        # Send current leaderboard
+        await websocket.send_bytes(await get_leaderboard_bytes())
+
         while True:
-            data = await websocket.receive_json()
-            # Basic validation
-            if "action" not in data or "card_id" not in data:
+            message = await websocket.receive()
+            if message["type"] == "websocket.disconnect":
+                raise WebSocketDisconnect(message.get("code", 1000))
+            # Clients send JSON in binary frames (no UTF-8 text decode); text frames from
+            # older clients or tools are still accepted. Parsed and validated in one pass.
+            payload = message.get("bytes") or message.get("text") or b""
+            try:
+                click = click_decoder.decode(payload)
+            except msgspec.DecodeError:
+                await websocket.send_bytes(orjson.dumps({"type": "error", "message": "Invalid message."}))
                 continue
 
-            if not game_state.is_round_active():
-                await websocket.send_json({"type": "error", "message": "Round not active."})
+            # Actions tagged with a previous round are rejected like any late click;
+            # clients that don't send round_id (older bundles, tools) aren't penalized
+            stale_round = click.round_id is not None and click.round_id != game_state.round_id
+            if not game_state.is_round_active() or stale_round:
+                await websocket.send_bytes(orjson.dumps({"type": "error", "message": "Round not active."}))
                 continue
             
             if manager.is_on_cooldown(client_id):
-                await websocket.send_json({"type": "error", "message": "Cooldown active."})
+                await websocket.send_bytes(orjson.dumps({"type": "error", "message": "Cooldown active."}))
                 continue
 
-            card_id = data["card_id"]
-            action = data["action"]  # "approve" or "denounce"
-            guess = "legitimo" if action == "approve" else "pirata"
+            card_id = click.card_id
+            guess = "legitimo" if click.action == "approve" else "pirata"
 
-            card = next((c for c in game_state.cards if c.id == card_id), None)
+            card = game_state.card_index.get(card_id)
 
             if card:
                 score_change = calculate_score(guess, card)
-                new_score = await update_score(client_id, nickname, score_change)
+                # Capture the round's key up front so a round switch mid-await can't split the write
+                round_id, leaderboard_key = game_state.round_id, game_state.leaderboard_key
+                if named_round_id != round_id:
+                    leaderboard_name = await claim_nickname(leaderboard_key, client_id, nickname)
+                    named_round_id = round_id
+                new_score = await update_score(leaderboard_key, leaderboard_name, score_change)
                 
                 # Send personal feedback to the player
-                await websocket.send_json({
+                await websocket.send_bytes(orjson.dumps({
                     "type": "feedback",
                     "card_id": card_id,
                     "correct": score_change > 0,
                     "correct_label": card.label,
                     "score_change": score_change,
                     "new_total_score": new_score
-                })
+                }))
 
-                # Broadcast updated leaderboard to everyone
-                leaderboard = await get_leaderboard()
-                await manager.broadcast({"type": "leaderboard_update", "leaderboard": leaderboard})
+                # Flag the leaderboard; the publisher broadcasts it in batches
+                leaderboard_dirty.set()
 
     except WebSocketDisconnect:
-        manager.disconnect(client_id)
+        manager.disconnect(client_id, websocket)
         logger.info(f"Client {client_id} disconnected.")
     except Exception as e:
         logger.error(f"Error in WebSocket for client {client_id}: {e}")
-        manager.disconnect(client_id)
+        manager.disconnect(client_id, websocket)
 
 
 # --- Startup Event ---
@@ -316,9 +553,11 @@ async def startup_event():
         # Depending on the policy, you might want to exit if Redis is not available
         # sys.exit(1)
 
-    # Start the main game loop in the background
-    asyncio.create_task(game_loop())
+    # Start the card prefetcher, main game loop and leaderboard publisher in the background
+    start_background_task(card_prefetcher(), "card_prefetcher")
+    start_background_task(game_loop(), "game_loop")
+    start_background_task(leaderboard_publisher(), "leaderboard_publisher")
 
 if __name__ == "__main__":
     import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=8000)
+    uvicorn.run(app, host="0.0.0.0", port=8000, loop="uvloop", ws="websockets", ws_per_message_deflate=True)
@@ -8,12 +8,16 @@ import Timer from './components/Timer';
 import Leaderboard from './components/Leaderboard';
 import OfferCard from './components/Card';
 
+const textDecoder = new TextDecoder();
+const textEncoder = new TextEncoder();
+
 // --- Zustand Store for State Management ---
 const useGameStore = create((set, get) => ({
   socket: null,
   connectionStatus: 'disconnected',
   player: null,
   cards: [],
+  roundId: null,
   roundEndsAt: null,
   leaderboard: [],
   feedback: {}, // { cardId: { correct, correct_label, score_change } }
@@ -53,6 +57,7 @@ const useGameStore = create((set, get) => ({
 
     const wsUrl = import.meta.env.VITE_API_URL || 'ws://localhost:8000/ws';
     const socket = new WebSocket(`${wsUrl}/${player.id}/${encodeURIComponent(player.nickname)}`);
+    socket.binaryType = 'arraybuffer'; // O servidor envia JSON pré-codificado em frames binários
 
     socket.onopen = () => {
       set({ connectionStatus: 'connected' });
@@ -60,12 +65,14 @@ const useGameStore = create((set, get) => ({
     };
 
     socket.onmessage = (event) => {
-      const data = JSON.parse(event.data);
+      const raw = typeof event.data === 'string' ? event.data : textDecoder.decode(event.data);
+      const data = JSON.parse(raw);
       switch (data.type) {
         case 'new_round':
         case 'game_state':
           set({ 
             cards: data.cards, 
+            roundId: data.round_id,
             roundEndsAt: data.expires_at,
             feedback: {}, // Reset feedback for new round
             leaderboard: data.leaderboard || get().leaderboard
@@ -112,9 +119,9 @@ const useGameStore = create((set, get) => ({
   },
 
   sendAction: (cardId, action) => {
-    const { socket, connectionStatus } = get();
+    const { socket, connectionStatus, roundId } = get();
     if (socket && connectionStatus === 'connected') {
-      socket.send(JSON.stringify({ action, card_id: cardId }));
+      socket.send(textEncoder.encode(JSON.stringify({ action, card_id: cardId, round_id: roundId })));
     }
   },
 }));